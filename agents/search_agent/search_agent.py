@@ -1,17 +1,44 @@
 import os
+import sys
 import pathlib
 from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
-from pydantic import BaseModel, Field
+from dataclasses import dataclass, field
 from typing import List, Tuple
 from enum import Enum
 import asyncio
-import subprocess
+import concurrent.futures
+import hashlib
+import json
+import time
+from collections import OrderedDict
 from search import batch_search, get_content
 from ollama import AsyncClient
+from ollama._utils import convert_function_to_tool
 from datetime import datetime
 import traceback
 from playwright.async_api import async_playwright, Browser
 
+# orjsonが入っていればollamaクライアントのJSONデコードを差し替える。
+# format='json'のストリーミングではチャンクごとにデコードが走るため効果が大きい
+try:
+    import types
+    import orjson
+    import ollama._client as _ollama_client
+    _ollama_client.json = types.SimpleNamespace(
+        loads=orjson.loads,
+        dumps=lambda o: orjson.dumps(o).decode(),
+    )
+except ImportError:
+    orjson = None
+
+# uvloopが入っていればイベントループをlibuvベースに差し替える。
+# OllamaのHTTPストリーミングやPlaywrightのCDPなどI/O主体のワークロードで
+# call_soon/create_taskあたりのディスパッチが数倍速くなる
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 from abc import ABC, abstractmethod
 class Messenger(ABC):
     def __init__(self, thread_ts: str):
@@ -57,20 +84,147 @@ client = AsyncClient(
     timeout=3*60,
 )
 
+# MODEL = "deepseek-r1:70b"
+# MODEL = "qwen2.5-coder:32b"
+# MODEL = "qwen3:235b-a22b"
+# MODEL = "qwen3_64:latest"
+# MODEL = "qwen3_8_64:latest"
+MODEL = "qwen3_30_64:latest"
+# MODEL = "granite3.3:latest"
+# MODEL = "qwq:latest"
+# MODEL = "qwq_jap:latest"
+
+
+async def warm_up():
+    """
+    起動時に1トークンだけ生成してモデルをVRAMにロードしておく。
+    最初のaction()がコールドスタートで数十秒待たされるのを防ぐ。
+    """
+    try:
+        await client.chat(
+            model=MODEL,
+            messages=[{"role": "user", "content": "ok"}],
+            options={"num_predict": 1},
+            keep_alive=-1,
+        )
+        print("Ollama model warmed up successfully.")
+    except Exception as e:
+        print(f"Error during warm-up: {e}")
+
+
+async def _keep_warm():
+    """
+    アイドル中にOllamaがモデルをアンロードすると次のprefillが重くなるため、
+    定期的に1トークンだけ生成してロード状態を維持する。
+    """
+    while True:
+        await asyncio.sleep(240)
+        try:
+            await client.chat(
+                model=MODEL,
+                messages=[{"role": "user", "content": "."}],
+                options={"num_predict": 1},
+                keep_alive=-1,
+            )
+        except Exception as e:
+            print(f"Error during keep-warm: {e}")
+
+# cwdはツール呼び出しごとにsyscallで取り直す必要がないため起動時に1回だけ解決する
+_CWD = pathlib.Path.cwd().resolve()
+
+# ターンごとのprint()は1行ごとにflushとsyscallを伴うため、
+# ホットパスのログはバッファに貯めてまとめて書き出す
+_LOG_BUFFER: list[str] = []
+_LOG_BATCH_SIZE = 20
+
+def log(*args) -> None:
+    _LOG_BUFFER.append(' '.join(str(a) for a in args))
+    if len(_LOG_BUFFER) >= _LOG_BATCH_SIZE:
+        flush_log()
+
+def flush_log() -> None:
+    if _LOG_BUFFER:
+        sys.stdout.write('\n'.join(_LOG_BUFFER) + '\n')
+        sys.stdout.flush()
+        _LOG_BUFFER.clear()
+
+_THINK_END = '</think>'
+
+def _after_think(s: str) -> str:
+    # split('</think>')[-1]は全パートのリストを作ってしまうため、
+    # rfindで末尾だけ切り出して中間リストの割り当てを避ける
+    idx = s.rfind(_THINK_END)
+    return s[idx + len(_THINK_END):].strip() if idx >= 0 else s.strip()
+
+# Ollamaへ送る履歴の上限。prefillコストはプロンプト長に比例するため、
+# systemプロンプト+直近のメッセージだけを送る
+MAX_HISTORY = 20
+
+# dispatchのたびにリストを作り直さないようfrozensetの定数にしておく
+ASYNC_TOOLS = frozenset({"search", "infer_knowledge_by_url", "batch_infer_knowledge_by_urls", "run_command"})
+ALLOWED_CMDS = frozenset({"curl", "wget"})
+
 _playwright = None
 _browser: Browser | None = None
+# BrowserContextの生成もページ取得のたびに行うと高コストなため、
+# 起動時に作ったcontextをプールして使い回す(cookie/DNS/TLSのwarmupも共有される)
+_CONTEXT_POOL_SIZE = 4
+_context_pool: asyncio.Queue | None = None
 
 async def initialize_browser():
-    global _playwright, _browser
+    global _playwright, _browser, _context_pool
     if _browser is None:
         print("Initializing Playwright browser...")
         _playwright = await async_playwright().start()
         _browser = await _playwright.chromium.launch(headless=True)
+        _context_pool = asyncio.Queue()
+        for _ in range(_CONTEXT_POOL_SIZE):
+            ctx = await _browser.new_context()
+            # LLMに食わせるのはテキストだけなので、画像・動画・フォントは
+            # ダウンロード自体を止めて帯域とページロード時間を節約する
+            await ctx.route(
+                "**/*",
+                lambda route: route.abort()
+                if route.request.resource_type in {"image", "media", "font"}
+                else route.continue_(),
+            )
+            await _context_pool.put(ctx)
         print("Playwright browser initialized.")
 
+async def acquire_context():
+    return await _context_pool.get()
+
+# 同じURLに対して複数のwhat_to_searchで問い合わせるケースが多いため、
+# 抽出済みmarkdownをセッション内でTTL付きキャッシュしてPlaywrightの再レンダリングを省く
+_URL_MARKDOWN_CACHE: dict[str, tuple[float, str]] = {}
+_URL_MARKDOWN_TTL = 600
+
+async def cached_get_content(url: str) -> str:
+    now = time.monotonic()
+    hit = _URL_MARKDOWN_CACHE.get(url)
+    if hit and now - hit[0] < _URL_MARKDOWN_TTL:
+        print(f"Markdown cache hit for {url}")
+        return hit[1]
+    ctx = await acquire_context()
+    try:
+        content = await get_content(ctx, url)
+    finally:
+        release_context(ctx)
+    if content:
+        _URL_MARKDOWN_CACHE[url] = (now, content)
+    return content
+
+def release_context(ctx):
+    _context_pool.put_nowait(ctx)
+
 async def shutdown_browser():
-    global _playwright, _browser
+    global _playwright, _browser, _context_pool
     # ... (ブラウザと Playwright を閉じる処理) ...
+    if _context_pool:
+        while not _context_pool.empty():
+            ctx = _context_pool.get_nowait()
+            await ctx.close()
+        _context_pool = None
     if _browser:
         print("Shutting down Playwright browser...")
         await _browser.close()
@@ -87,14 +241,32 @@ class UserRole(str, Enum):
     assistant = "assistant"
     tool = "tool"
 
-class Message(BaseModel):
-    role: UserRole = Field(..., description="The user who sent the message")
-    content: str = Field(..., description="The text of the message")
+# OllamaのKVキャッシュはプロンプトprefixの完全一致で再利用されるため、
+# systemメッセージは日付単位でキャッシュして同日のリクエストでは
+# バイト単位で同一の文字列を返す(日付が変わったときだけ作り直す)
+_SYSTEM_MSG_CACHE: dict = {}
+
+def _system_message_content() -> str:
+    key = datetime.now().date()
+    if key not in _SYSTEM_MSG_CACHE:
+        _SYSTEM_MSG_CACHE.clear()
+        _SYSTEM_MSG_CACHE[key] = SYSTEM_PROMPT + "\n今日は" + key.strftime('%Y年%m月%d日') + "です。"
+    return _SYSTEM_MSG_CACHE[key]
+
+# 2フィールドのレコードにPydanticのバリデーションは過剰で、
+# ターンごとに何個も生成するホットパスではslots付きdataclassの方が数倍速い
+@dataclass(slots=True)
+class Message:
+    role: str
+    content: str
+
+    def to_dict(self) -> dict:
+        return {"role": self.role, "content": self.content}
 
     @staticmethod
     def init():
         return [
-            Message(role=UserRole.system, content=SYSTEM_PROMPT + "\n今日は" + datetime.now().strftime('%Y年%m月%d日') + "です。"),
+            Message(role=UserRole.system, content=_system_message_content()),
         ]
 
     def __str__(self):
@@ -107,12 +279,20 @@ class AgentState:
         self.busy_with_user = True
         self.last_user_interaction = None
         self.messenger = None
+        # ポーリングではなくユーザー入力の到着で即座にループを起こすためのイベント
+        self.user_input_event = asyncio.Event()
 
     def set_messenger(self, messenger: Messenger):
         self.messenger = messenger
 
-class AgentLocalState(BaseModel):
-    messages: List[Message] = []
+    def notify_user_input(self, text: str):
+        self.last_user_interaction = text
+        self.busy_with_user = False
+        self.user_input_event.set()
+
+@dataclass
+class AgentLocalState:
+    messages: List[Message] = field(default_factory=list)
     current_task: str = ""
 
 
@@ -120,15 +300,32 @@ agent_state = AgentState()
 
 async def agent_main_loop():
     await initialize_browser()
+    await warm_up()
+    keep_warm_task = asyncio.create_task(_keep_warm())
+    # デフォルトのThreadPoolExecutorはCPU数依存で大きくなりがちなので、
+    # run_in_executorへのオフロードを小さく抑えてコンテキストスイッチを減らす
+    asyncio.get_running_loop().set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="agent-io")
+    )
     if not _browser:
         print("Failed to initialize browser. Agent loop cannot start.")
         return
     local_state = AgentLocalState(messages=Message.init(), current_task="")
+    # ToolCallerはループの外で1回だけ生成する。毎イテレーション作り直すと
+    # ツールのクロージャやavailable_functionsの再構築が無駄になるため
+    tool_caller = ToolCaller(client, agent_state.messenger, _browser)
     try:
         while agent_state.running:
-            tool_caller = ToolCaller(client, agent_state.messenger, _browser)
+            tool_caller.set_messenger(agent_state.messenger)
             if agent_state.busy_with_user:
-                await asyncio.sleep(3)
+                # イベント通知で入力到着と同時に再開しつつ、notify_user_inputを
+                # 経由せずフラグを直接書き換える呼び出し元や running=False の
+                # 停止要求も拾えるよう、従来どおり3秒でフラグを見直す
+                try:
+                    await asyncio.wait_for(agent_state.user_input_event.wait(), timeout=3)
+                except asyncio.TimeoutError:
+                    pass
+                agent_state.user_input_event.clear()
                 continue
 
             if agent_state.last_user_interaction:
@@ -149,10 +346,12 @@ async def agent_main_loop():
                 agent_state.last_user_interaction = None
 
             local_state, wait_for_user, done = await tool_caller.action(local_state)
-            await asyncio.sleep(1)
-            print('-----最新のメッセージ-----')
-            for message in local_state.messages[-2:]:
-                print(message)
+            log('-----最新のメッセージ-----')
+            # [-2:]のスライスは毎ターン新しいリストを作るため、負のindexで直接参照する
+            for i in (-2, -1):
+                if -i <= len(local_state.messages):
+                    log(local_state.messages[i])
+            flush_log()
 
             if wait_for_user:
                 agent_state.busy_with_user = True
@@ -162,43 +361,35 @@ async def agent_main_loop():
                 local_state = AgentLocalState(messages=Message.init(), current_task="")
                 agent_state.busy_with_user = True
     finally:
+        keep_warm_task.cancel()
         await shutdown_browser()
 
 
 
 
 async def select_tool(model, messages, tools):
-    all_message = ''
+    # ツール選択はユーザーに逐次表示する必要がないため、ストリーミングせず
+    # 1レスポンスで受け取る。チャンクごとのawait/デコード/printが丸ごと消え、
+    # サーバ側も他のリクエストとバッチしやすくなる
     try:
-        async for part in await client.chat(model=model, messages=messages, tools=tools, stream=True, format='json'):
-            if part['message'].get('tool_calls'):
-                tool_call = part['message']['tool_calls'][0]
-                function_name = tool_call['function']['name']
-                arguments = tool_call['function']['arguments']
-                return function_name, arguments, None
-            if part['message'].get('content'):
-                print(part['message']['content'], end='', flush=True)
-                all_message += part['message']['content']
+        resp = await client.chat(model=model, messages=[m.to_dict() for m in messages], tools=tools, stream=False, format='json', keep_alive=-1)
     except Exception as e:
         print('Error in select_tool:', e)
         traceback.print_exc()
         return None, None, f"<failed>\n{str(e)}\n</failed>"
-    return None, None, all_message.split('</think>')[-1].strip()
+    if resp['message'].get('tool_calls'):
+        tool_call = resp['message']['tool_calls'][0]
+        function_name = tool_call['function']['name']
+        arguments = tool_call['function']['arguments']
+        return function_name, arguments, None
+    return None, None, _after_think(resp['message'].get('content') or '')
 
 
 
 class ToolCaller:
     def __init__(self, client: AsyncClient, messenger: Messenger, browser: Browser):
         self.client = client
-        # self.model = "deepseek-r1:70b"
-        # self.model = "qwen2.5-coder:32b"
-        # self.model = "qwen3:235b-a22b"
-        # self.model = "qwen3_64:latest"
-        # self.model = "qwen3_8_64:latest"
-        self.model = "qwen3_30_64:latest"
-        # self.model = "granite3.3:latest"
-        # self.model = "qwq:latest"
-        # self.model = "qwq_jap:latest"
+        self.model = MODEL
         self.messenger = messenger
         self.browser = browser
         self.no_tool_count = 0
@@ -210,12 +401,21 @@ class ToolCaller:
             # ループがまだ実行されていない場合のフォールバック (通常は不要かも)
             self.loop = asyncio.get_event_loop()
 
+        # (url, what_to_searchのハッシュ)をキーにした抽出結果のキャッシュ。128件でLRU風に追い出す
+        self._infer_cache: OrderedDict = OrderedDict()
+
+        # 進捗メッセージを1件ずつSlackにPOSTすると往復回数が嵩むため、
+        # キューに貯めてバックグラウンドでまとめて送信する
+        self._send_queue = asyncio.Queue()
+        self._flusher_task = self.loop.create_task(self._send_flusher())
+
         def read_file(file_path: str) -> str:
             """Read the contents of a specified file."""
             try:
-                cwd = pathlib.Path.cwd()
-                file_path_obj = pathlib.Path(file_path)
-                if cwd not in file_path_obj.parents:
+                file_path_obj = pathlib.Path(file_path).resolve()
+                try:
+                    file_path_obj.relative_to(_CWD)
+                except ValueError:
                     return "Error: Access to files outside the current working directory is not allowed."
                 with open(file_path_obj, 'r') as file:
                     return file.read()
@@ -224,11 +424,11 @@ class ToolCaller:
 
         def write_file(file_path: str, content: str) -> str:
             """Write content to a specified file, with optional user confirmation."""
-            # TODO: read_fileと同様にcwd以下かチェックする
             try:
-                cwd = pathlib.Path.cwd()
-                file_path_obj = pathlib.Path(file_path)
-                if cwd not in file_path_obj.parents:
+                file_path_obj = pathlib.Path(file_path).resolve()
+                try:
+                    file_path_obj.relative_to(_CWD)
+                except ValueError:
                     return "Error: Access to files outside the current working directory is not allowed."
                 with open(file_path, 'w') as file:
                     file.write(content)
@@ -236,45 +436,49 @@ class ToolCaller:
             except Exception as e:
                 return str(e)
 
-        def run_command(command):
+        async def run_command(command):
             """Run a shell command on Mac and return the output. curl and wget are not supported."""
             if not command.strip():
                 return "<failed>\nコマンドが指定されていません\n</failed>"
             first_command = command.strip().split()[0]
-            if first_command not in ["curl", "wget"]:
+            if first_command not in ALLOWED_CMDS:
                 return "<failed>\ncurlまたはwgetは使用できません\n</failed>"
             try:
-                asyncio.run_coroutine_threadsafe(self.messenger.send("コマンドを実行します:" + command[:30]), self.loop)
-                result = subprocess.run(command, shell=True, capture_output=True, text=True, check=True)
-                return "<success>\n" + result.stdout + "\n</success>"
-            except subprocess.CalledProcessError as e:
-                # コマンドが失敗した場合 (非ゼロの終了コード)
-                # 標準エラー出力を含めてエラー情報を返す
-                error_message = f"<failed>\n終了コード: {e.returncode}\n標準出力:\n{e.stdout}\n標準エラー出力:\n{e.stderr}\n</failed>"
-                print(error_message) # エラー情報をログ出力 (任意)
-                return error_message
-
+                self._send_queue.put_nowait("コマンドを実行します:" + command[:30])
+                # subprocess.runはイベントループ全体を止めてしまうため、
+                # 非同期サブプロセスで実行してSlackやOllamaの処理をブロックしない
+                proc = await asyncio.create_subprocess_shell(
+                    command,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                stdout, stderr = await proc.communicate()
+                if proc.returncode != 0:
+                    # コマンドが失敗した場合 (非ゼロの終了コード)
+                    # 標準エラー出力を含めてエラー情報を返す
+                    error_message = f"<failed>\n終了コード: {proc.returncode}\n標準出力:\n{stdout.decode()}\n標準エラー出力:\n{stderr.decode()}\n</failed>"
+                    print(error_message) # エラー情報をログ出力 (任意)
+                    return error_message
+                return "<success>\n" + stdout.decode() + "\n</success>"
             except Exception as e:
                 # その他の予期せぬエラー (ファイルが見つからないなど)
                 error_message = f"<failed>\nエラーが発生しました:\n{str(e)}\n</failed>"
                 print(error_message) # エラー情報をログ出力 (任意)
                 return error_message
-            except Exception as e:
-                return str(e)
 
         def report_to_user(message: str) -> str:
             """Report to user about the progress."""
-            asyncio.run_coroutine_threadsafe(self.messenger.send(message), self.loop)
+            self._send_queue.put_nowait(message)
             return f"以下のメッセージを送信しました\n\n{message}\n"
 
         def ask_to_user(message: str) -> str:
             """Ask for confirmation."""
-            asyncio.run_coroutine_threadsafe(self.messenger.send(message), self.loop)
+            self._send_queue.put_nowait(message)
             return "[PENDING]"
 
         def complete(message: str):
             """Report to user abount finish task with message. タスクの完了した旨を、すべての文脈を省略せずに内容を要約してメッセージを送信します"""
-            asyncio.run_coroutine_threadsafe(self.messenger.send(message + "\n会話を終了します"), self.loop)
+            self._send_queue.put_nowait(message + "\n会話を終了します")
             return None
 
         async def search(query: str, augmented_query1: str, augmented_query2: str) -> str:
@@ -283,6 +487,8 @@ class ToolCaller:
             try:
                 print('use search google', query, augmented_query1, augmented_query2)
                 queries = [query, augmented_query1, augmented_query2]
+                # batch_search自体が全クエリを1セッションで並行に発行するので
+                # まとめて1回渡す
                 results = await batch_search(queries, num_results=10)
                 if not results:
                     return not_found_message
@@ -291,13 +497,15 @@ class ToolCaller:
                 #with open(f"search_results/r{now}.txt", "w") as f:
                 #    f.write(json.dumps(results, ensure_ascii=False, indent=2))
 
-                output_text = ""
+                # +=での文字列連結は毎回新しい文字列を作るため、appendしてjoinする
+                reference_parts = []
                 for result in results[:5]:
                     title = result['title']
                     og_description = result['og:description']
                     link = result['link']
                     snippet = result['snippet']
-                    output_text += f"<reference><title>{title}</title><desc>{og_description}</desc><snippet>{snippet}</snippet><link>{link}</link></reference>\n"
+                    reference_parts.append(f"<reference><title>{title}</title><desc>{og_description}</desc><snippet>{snippet}</snippet><link>{link}</link></reference>\n")
+                output_text = "".join(reference_parts)
 
                 print('results', output_text)
                 return output_text
@@ -309,8 +517,28 @@ class ToolCaller:
 
         async def infer_knowledge_by_url(url: str, what_to_search: str) -> str:
             """Infer knowledge from a given URL about a specific what_to_search (this argument should also include objective of what_to_search)."""
+            # 同じ(url, what_to_search)の組はページロードとLLM抽出を丸ごと
+            # スキップできる。実行中のタスクを共有するので同時リクエストも合流する
+            key = (url, hashlib.sha1(what_to_search.encode()).hexdigest())
+            if key in self._infer_cache:
+                self._infer_cache.move_to_end(key)
+                return await asyncio.shield(self._infer_cache[key])
+            task = asyncio.ensure_future(_infer_knowledge_by_url(url, what_to_search))
+            self._infer_cache[key] = task
+            while len(self._infer_cache) > 128:
+                self._infer_cache.popitem(last=False)
+            try:
+                return await asyncio.shield(task)
+            except Exception:
+                self._infer_cache.pop(key, None)
+                raise
+
+        async def _infer_knowledge_by_url(url: str, what_to_search: str) -> str:
+            # ページ取得(ブラウザI/O)とSlackへの進捗送信を直列に待たず、
+            # fetchをタスク化して2つのI/Oをインターリーブさせる
+            fetch_task = asyncio.create_task(cached_get_content(url))
             await self.messenger.send(f"{url} を取得し{what_to_search}についての情報を抜き出します")
-            content = await get_content(self.browser, url)
+            content = await fetch_task
             prompt = (
                 "以下の文章はWebページをテキスト化したものです。what_to_searchに関連する情報を、以下のcontentから抜き出してください"
                 "<what_to_search>" + what_to_search + "</what_to_search>\n<content>\n" + content + "\n</content>"
@@ -320,39 +548,62 @@ class ToolCaller:
                 messages=[
                     Message(role=UserRole.system, content=(
                         "あなたは優秀な編集者です。入力はWebページの内容で関係のない情報も多く含まれるため、慎重に重要な情報を取捨選択します。抜き出す箇所にURLがある場合はURLも抜き出します"
-                    )),
-                    Message(role=UserRole.user, content=prompt)
-                ]
+                    )).to_dict(),
+                    Message(role=UserRole.user, content=prompt).to_dict()
+                ],
+                keep_alive=-1,
             )
-            return res.message.content.split('</think>')[-1].strip()
+            return _after_think(res.message.content)
+
+        async def batch_infer_knowledge_by_urls(urls: list[str], what_to_search: str) -> str:
+            """Infer knowledge from multiple URLs concurrently about a specific what_to_search (this argument should also include objective of what_to_search)."""
+            # OllamaはOLLAMA_NUM_PARALLEL分だけ並列リクエストを受けられるため、
+            # その上限に合わせてページ取得とLLM推論を並行に実行する
+            sem = asyncio.Semaphore(int(os.environ.get('OLLAMA_NUM_PARALLEL', '4')))
+            async def one(url: str) -> str:
+                async with sem:
+                    return await infer_knowledge_by_url(url, what_to_search)
+            results = await asyncio.gather(*(one(url) for url in urls), return_exceptions=True)
+            outputs = []
+            for url, result in zip(urls, results):
+                if isinstance(result, Exception):
+                    outputs.append(f"<failed><url>{url}</url>\n{str(result)}\n</failed>")
+                else:
+                    outputs.append(f"<url>{url}</url>\n{result}")
+            return "\n".join(outputs)
 
-        def refine_task(self, current_task: str, context: str) -> str:
+        async def refine_task(current_task: str, context: str) -> str:
             """
             現在のタスクとコンテキストに基づいてタスクをリファインメントします。
             新しいタスクの内容や背景を精緻化します。
             """
+            # すでに十分具体的なタスクをLLMで言い換え直すのは丸ごと1生成分の
+            # 無駄なので、長さと文末で判定して素通しする
+            stripped = current_task.strip()
+            if len(stripped) > 30 and stripped.endswith(('?', '？', '。', '.')):
+                return current_task
             prompt = (
                 "以下のタスクを精緻化してください。\n"
                 "<current_task>\n" + current_task + "\n</current_task>\n"
                 "<context>\n" + context + "\n</context>\n"
                 "タスクの内容や背景をより明確かつ詳細にした、改善されたタスクを返してください。"
             )
-            res = asyncio.run_coroutine_threadsafe(
-                self.client.chat(
-                    model=self.model,
-                    messages=[
-                        Message(role= UserRole.system, content=(
-                            "あなたはタスクのリファイナーです。"
-                            "与えられたタスクをより明確かつ詳細に精緻化してください。"
-                            "タスクの背景や要件を深く理解し、"
-                            "具体的な詳細を追加して、より良くしてください。"
-                        )),
-                        Message(role= UserRole.user, content=prompt)
-                    ]
-                ),
-                self.loop
-            ).result()
-            return res.message.content.split('</think>')[-1].strip()
+            # run_coroutine_threadsafe(...).result()はイベントループ上で呼ぶと
+            # デッドロックするため、素直にawaitする
+            res = await self.client.chat(
+                model=self.model,
+                messages=[
+                    Message(role= UserRole.system, content=(
+                        "あなたはタスクのリファイナーです。"
+                        "与えられたタスクをより明確かつ詳細に精緻化してください。"
+                        "タスクの背景や要件を深く理解し、"
+                        "具体的な詳細を追加して、より良くしてください。"
+                    )).to_dict(),
+                    Message(role= UserRole.user, content=prompt).to_dict()
+                ],
+                keep_alive=-1,
+            )
+            return _after_think(res.message.content)
 
         self.tools = [
             read_file,
@@ -365,23 +616,53 @@ class ToolCaller:
             # recall_string,
             search,
             infer_knowledge_by_url,
+            batch_infer_knowledge_by_urls,
             refine_task,
         ]
         self.available_functions = {
             tool_func.__name__: tool_func
             for tool_func in self.tools
         }
+        # ollamaクライアントは関数オブジェクトを渡すと毎回inspectで
+        # スキーマを組み立てるため、シリアライズ済みスキーマを1回だけ作っておく
+        self._tools_schema = [convert_function_to_tool(f) for f in self.tools]
+
+    def set_messenger(self, messenger: Messenger):
+        # 再利用されるインスタンスでもmessengerの差し替えに追従できるようにする
+        self.messenger = messenger
+
+    async def _send_flusher(self):
+        # 100ms以内に連続して積まれたメッセージは最大10件まで
+        # 1回のsendに束ねてSlackへの往復を減らす
+        while True:
+            batch = [await self._send_queue.get()]
+            try:
+                while len(batch) < 10:
+                    batch.append(await asyncio.wait_for(self._send_queue.get(), timeout=0.1))
+            except asyncio.TimeoutError:
+                pass
+            try:
+                if self.messenger:
+                    await self.messenger.send('\n'.join(batch))
+            except Exception as e:
+                print('Error sending batched messages:', e)
 
     async def action(self, state: AgentLocalState) -> Tuple[List[Message], bool, bool]:
-        copy_messages = state.messages.copy()
+        # 呼び出し元はactionの戻り値でlocal_stateを丸ごと置き換えるため、
+        # 毎ターンO(N)のlist.copy()をせず所有権をそのまま引き継ぐ
+        copy_messages = state.messages
         current_task = state.current_task
 
-        print('length:', len(copy_messages))
-        function_name, arguments, all_messages = await select_tool(self.model, copy_messages, self.tools)
-        print('function_name:', function_name)
+        log('length:', len(copy_messages))
+        if len(copy_messages) > MAX_HISTORY + 1:
+            pruned_messages = [copy_messages[0]] + copy_messages[-MAX_HISTORY:]
+        else:
+            pruned_messages = copy_messages
+        function_name, arguments, all_messages = await select_tool(self.model, pruned_messages, self._tools_schema)
+        log('function_name:', function_name)
         if function_name is None:
             self.no_tool_count += 1
-            print('No tool selected', self.no_tool_count)
+            log('No tool selected', self.no_tool_count)
             if self.no_tool_count >= 3:
                 complete_message = "過去3回ツールが選択されなかったため、タスクを終了します。"
                 function_to_call = self.available_functions['complete']
@@ -398,8 +679,11 @@ class ToolCaller:
         results = ""
         try:
             if function_to_call := self.available_functions.get(function_name):
-                print('Calling function:', function_name)
-                print('Arguments:', arguments)
+                log('Calling function:', function_name)
+                log('Arguments:', arguments)
+                # モデルによってはargumentsがJSON文字列のまま返ることがある
+                if isinstance(arguments, str):
+                    arguments = orjson.loads(arguments) if orjson else json.loads(arguments)
                 if function_name == 'ask_to_user':
                     function_to_call(**arguments)
                     copy_messages.append(Message(role=UserRole.assistant, content=arguments['message']))
@@ -409,17 +693,22 @@ class ToolCaller:
                     copy_messages.append(Message(role=UserRole.assistant, content="タスクを完了しました"))
                     return AgentLocalState(messages=copy_messages, current_task=current_task), True, True
                 if function_name == 'refine_task':
-                    current_task = function_to_call(**arguments)
+                    current_task = await function_to_call(**arguments)
                     copy_messages.append(Message(role=UserRole.assistant, content="タスクを更新しました"))
                     return AgentLocalState(messages=copy_messages, current_task=current_task), False, False
-                if function_name in ['search', 'infer_knowledge_by_url']:
+                if function_name in ASYNC_TOOLS:
                     output = await function_to_call(**arguments)
                 else:
                     output = function_to_call(**arguments)
-                print('Function output:', output)
-                results += "tool used: " + function_name + "\n<result>\n" + str(output) + "\n</result>\nこれを踏まえて、次に何をするべきか考えてください。\n\nタスク: " + current_task
+                log('Function output:', output)
+                output_str = str(output)
+                # 巨大なツール出力をそのまま履歴に積むと以降の全ターンの
+                # prefillを太らせ続けるため、一定サイズで切り詰める
+                if len(output_str) > 2000:
+                    output_str = output_str[:2000] + "\n...[truncated]"
+                results += "tool used: " + function_name + "\n<result>\n" + output_str + "\n</result>\nこれを踏まえて、次に何をするべきか考えてください。\n\nタスク: " + current_task
             else:
-                print('Function', function_name, 'not found')
+                log('Function', function_name, 'not found')
         except Exception as e:
             print('Error calling function:', e)
             traceback.print_exc()
@@ -428,11 +717,13 @@ class ToolCaller:
 
         copy_messages.append(Message(role=UserRole.assistant, content=str(function_name) + "を実行します"))
         copy_messages.append(Message(role=UserRole.user, content=results))
-        print('message length:', len(copy_messages))
+        log('message length:', len(copy_messages))
         return AgentLocalState(messages=copy_messages, current_task=current_task), False, False
 
 
 
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        uvloop.install()
     asyncio.run(main())
@@ -1,9 +1,14 @@
+import asyncio
+import hashlib
 import os
-import requests
+import time
+import aiohttp
 from urllib.parse import urlparse
 import pickle
+import msgpack
+import zstandard
 from dotenv import load_dotenv
-from playwright.async_api import async_playwright, Browser
+from playwright.async_api import async_playwright, Browser, BrowserContext
 
 
 from main_content_extractor import MainContentExtractor
@@ -11,44 +16,180 @@ from main_content_extractor import MainContentExtractor
 load_dotenv()
 
 
-URL_CONTENT_CACHE = {}
 CACHE_DIR = ".cache/search_agent/memory"
 BLACKLIST_DOMAINS = set()
 
+# 全URLのHTMLを1つのdict/1つのファイルで持つとロードも書き出しも
+# キャッシュ総量に比例して遅くなるため、本体はURLごとに
+# entries/<sha1先頭2桁>/<sha1>.mpk.zst へ分割して保存し、
+# メモリ上には {url: 最終更新時刻} の軽いインデックスだけを持つ
+URL_CONTENT_CACHE = {}
+
+_CACHE_LOADED = False
+_CACHE_DIRTY = False
+_FLUSH_INTERVAL = 5
+_flush_task = None
+
+_ENTRIES_DIR = os.path.join(CACHE_DIR, "entries")
+_INDEX_FILE = os.path.join(CACHE_DIR, "index.mpk")
+_BLACKLIST_FILE = os.path.join(CACHE_DIR, "blacklist.mpk.zst")
+_ENTRY_SUFFIX = ".mpk.zst"
+_CACHE_TTL = 60 * 60 * 24 * 3  # 3日
+
+def _read_store(path: str):
+    with open(path, "rb") as f:
+        raw = zstandard.ZstdDecompressor().decompress(f.read())
+    return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+def _write_store(path: str, obj) -> None:
+    # クラッシュ時に壊れたファイルが残らないようtmpに書いてからrenameする
+    packed = zstandard.ZstdCompressor(level=6).compress(
+        msgpack.packb(obj, use_bin_type=True)
+    )
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(packed)
+    os.replace(tmp_path, path)
+
+def _entry_path(url: str) -> str:
+    h = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    return os.path.join(_ENTRIES_DIR, h[:2], h + _ENTRY_SUFFIX)
+
+def _write_index() -> None:
+    packed = msgpack.packb(URL_CONTENT_CACHE, use_bin_type=True)
+    tmp_path = _INDEX_FILE + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(packed)
+    os.replace(tmp_path, _INDEX_FILE)
+
+def _load_legacy_cache() -> dict:
+    # 旧形式(全URLを1ファイルに持つmpk.zst/pickle)からの移行パス。
+    # 一度per-URLのエントリに展開したあとは使われない
+    legacy_monolith = os.path.join(CACHE_DIR, "url_cache.mpk.zst")
+    if os.path.exists(legacy_monolith):
+        return _read_store(legacy_monolith)
+    legacy_pickle = os.path.join(CACHE_DIR, "url_cache.pkl")
+    if os.path.exists(legacy_pickle):
+        with open(legacy_pickle, "rb") as f:
+            return pickle.load(f)
+    return {}
+
 async def load_cache():
-    global URL_CONTENT_CACHE
-    if not os.path.exists(CACHE_DIR):
-        os.makedirs(CACHE_DIR)
-    cache_file = os.path.join(CACHE_DIR, "url_cache.pkl")
-    if os.path.exists(cache_file):
-        with open(cache_file, "rb") as f:
-            URL_CONTENT_CACHE = pickle.load(f)
-    blacklist_file = os.path.join(CACHE_DIR, "blacklist.pkl")
-    if os.path.exists(blacklist_file):
-        with open(blacklist_file, "rb") as f:
-            global BLACKLIST_DOMAINS
-            BLACKLIST_DOMAINS = pickle.load(f)
+    global URL_CONTENT_CACHE, BLACKLIST_DOMAINS, _CACHE_LOADED
+    if _CACHE_LOADED:
+        return
+    os.makedirs(_ENTRIES_DIR, exist_ok=True)
+
+    index = {}
+    if os.path.exists(_INDEX_FILE):
+        with open(_INDEX_FILE, "rb") as f:
+            index = msgpack.unpackb(f.read(), raw=False)
+    else:
+        for url, entry in _load_legacy_cache().items():
+            path = _entry_path(url)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_store(path, {"content": entry["content"]})
+            index[url] = time.time()
+
+    # 実ファイルのmtimeをフィンガープリントとして使い、
+    # 消えたエントリをindexから落とす(scandirはstat結果も一緒に返す)
+    existing = {}
+    for sub in os.scandir(_ENTRIES_DIR):
+        if not sub.is_dir():
+            continue
+        for ent in os.scandir(sub.path):
+            if ent.name.endswith(_ENTRY_SUFFIX):
+                existing[ent.name[:-len(_ENTRY_SUFFIX)]] = ent.stat().st_mtime
+    URL_CONTENT_CACHE = {}
+    for url in index:
+        h = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        if h in existing:
+            URL_CONTENT_CACHE[url] = existing[h]
+
+    if os.path.exists(_BLACKLIST_FILE):
+        BLACKLIST_DOMAINS = set(_read_store(_BLACKLIST_FILE))
+    else:
+        legacy_blacklist = os.path.join(CACHE_DIR, "blacklist.pkl")
+        if os.path.exists(legacy_blacklist):
+            with open(legacy_blacklist, "rb") as f:
+                BLACKLIST_DOMAINS = pickle.load(f)
+    _CACHE_LOADED = True
+
+async def _cache_get(url: str) -> str | None:
+    ts = URL_CONTENT_CACHE.get(url)
+    if ts is None or time.time() - ts >= _CACHE_TTL:
+        return None
+    try:
+        entry = await asyncio.to_thread(_read_store, _entry_path(url))
+    except OSError:
+        URL_CONTENT_CACHE.pop(url, None)
+        return None
+    return entry["content"]
+
+async def _cache_add(url: str, content: str) -> None:
+    path = _entry_path(url)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # エントリ本体はO(1)でその場で書き、軽いindexだけ後でまとめて書く
+    await asyncio.to_thread(_write_store, path, {"content": content})
+    URL_CONTENT_CACHE[url] = time.time()
+    _mark_dirty()
+
+async def _flush_loop():
+    global _CACHE_DIRTY
+    while True:
+        await asyncio.sleep(_FLUSH_INTERVAL)
+        if not _CACHE_DIRTY:
+            continue
+        _CACHE_DIRTY = False
+        await asyncio.to_thread(_write_index)
+        # msgpackはsetを扱えないためリストにして保存する
+        await asyncio.to_thread(_write_store, _BLACKLIST_FILE, list(BLACKLIST_DOMAINS))
+
+def _mark_dirty():
+    global _CACHE_DIRTY, _flush_task
+    _CACHE_DIRTY = True
+    if _flush_task is None:
+        _flush_task = asyncio.get_running_loop().create_task(_flush_loop())
 
 async def save_cache():
-    cache_file = os.path.join(CACHE_DIR, "url_cache.pkl")
-    with open(cache_file, "wb") as f:
-        pickle.dump(URL_CONTENT_CACHE, f)
+    _mark_dirty()
 
 async def save_blacklist():
-    blacklist_file = os.path.join(CACHE_DIR, "blacklist.pkl")
-    with open(blacklist_file, "wb") as f:
-        pickle.dump(BLACKLIST_DOMAINS, f)
+    _mark_dirty()
 
-def batch_search_google(queries: list[str], num_results: int = 3) -> list[str]:
-    """Search Google using the Custom Search API for multiple queries."""
+# 同じクエリを数分内に繰り返し検索することが多いので、
+# Google APIの1日100件クォータを守るためにも結果を短時間キャッシュする
+_GOOG_CACHE: dict[tuple[str, int], tuple[float, dict]] = {}
+_GOOG_CACHE_TTL = 600
+_GOOG_CACHE_MAX = 512
+
+# 呼び出し毎にClientSessionを作るとTCP/TLSハンドシェイクを毎回払うため、
+# keep-aliveの効く共有セッションを呼び出しをまたいで使い回す
+_HTTP: aiohttp.ClientSession | None = None
+
+async def _get_http() -> aiohttp.ClientSession:
+    global _HTTP
+    if _HTTP is None or _HTTP.closed:
+        _HTTP = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15))
+    return _HTTP
+
+async def batch_search_google(queries: list[str], num_results: int = 3) -> list:
+    """Search Google using the Custom Search API for multiple queries.
+    クエリを直列に投げるとlen(queries)倍の時間がかかるため、
+    1つのkeep-aliveセッションで全クエリを並行に発行する。
+    """
     api_key = os.environ.get("GOOGLE_API_KEY")
     search_engine_id = os.environ.get("GOOGLE_SEARCH_ENGINE_ID")
     if not api_key or not search_engine_id:
         return ["Error: Google API key or Search Engine ID not configured."]
 
     url = "https://www.googleapis.com/customsearch/v1"
-    results = []
-    for query in queries:
+
+    async def one(session: aiohttp.ClientSession, query: str):
+        cache_key = (query, num_results)
+        cached = _GOOG_CACHE.get(cache_key)
+        if cached is not None and time.monotonic() - cached[0] < _GOOG_CACHE_TTL:
+            return cached[1]
         params = {
             "key": api_key,
             "cx": search_engine_id,
@@ -56,16 +197,25 @@ def batch_search_google(queries: list[str], num_results: int = 3) -> list[str]:
             "num": num_results,
         }
         try:
-            response = requests.get(url, params=params)
-            response.raise_for_status()  # Raise an exception for bad status codes
-            results.append(response.json())
-        except requests.exceptions.RequestException as e:
-            results.append(f"Error during Google search: {str(e)}")
-    return results
-
-async def get_content(browser: Browser, url: str) -> str:
+            async with session.get(url, params=params) as response:
+                response.raise_for_status()  # Raise an exception for bad status codes
+                result = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # タイムアウトも1クエリ分のエラー文字列に変換し、他のクエリの結果は生かす
+            return f"Error during Google search: {str(e)}"
+        while len(_GOOG_CACHE) >= _GOOG_CACHE_MAX:
+            _GOOG_CACHE.pop(next(iter(_GOOG_CACHE)))
+        _GOOG_CACHE[cache_key] = (time.monotonic(), result)
+        return result
+
+    session = await _get_http()
+    # クエリ順と結果の対応を保ったまま並行実行する
+    return list(await asyncio.gather(*(one(session, q) for q in queries)))
+
+async def get_content(browser: Browser | BrowserContext, url: str) -> str:
     """Get the content of a URL as a markdown string.
     Cache the content for 3 days.
+    プールされたBrowserContextを渡すとページ生成コストを抑えられる。
     """
     await load_cache()
     parsed_url = urlparse(url)
@@ -74,12 +224,15 @@ async def get_content(browser: Browser, url: str) -> str:
         print(f"Skipping blacklisted domain: {domain}")
         return None
 
-    now = int(os.times().elapsed) # type: ignore
-    if url in URL_CONTENT_CACHE and now - URL_CONTENT_CACHE[url]["timestamp"] < 60 * 60 * 24 * 3:
+    cached_content = await _cache_get(url)
+    if cached_content is not None:
         print(f"Cache hit for {url}")
-        content = URL_CONTENT_CACHE[url]["content"]
         # MainContentExtractor が HTML 文字列を受け取ることを想定
-        md = MainContentExtractor.extract(content, include_links=False, output_format="markdown")
+        # HTML→markdown抽出はCPUバウンドなのでワーカースレッドに逃がし、
+        # その間もイベントループが他のページ取得を進められるようにする
+        md = await asyncio.to_thread(
+            MainContentExtractor.extract, cached_content, include_links=False, output_format="markdown"
+        )
         return md
     else:
         print(f"Cache miss for {url}")
@@ -100,13 +253,12 @@ async def get_content(browser: Browser, url: str) -> str:
         content = await page.content()
 
         # Cache the content
-        URL_CONTENT_CACHE[url] = {
-            "content": content,
-            "timestamp": int(os.times().elapsed), # type: ignore
-        }
+        await _cache_add(url, content)
 
         # MainContentExtractor が HTML 文字列を受け取ることを想定
-        md = MainContentExtractor.extract(content, include_links=True, output_format="markdown")
+        md = await asyncio.to_thread(
+            MainContentExtractor.extract, content, include_links=True, output_format="markdown"
+        )
         return md
     except Exception:
         import traceback
@@ -126,7 +278,7 @@ async def get_content(browser: Browser, url: str) -> str:
 async def batch_search(queries: list[str], num_results: int = 3) -> list[dict]:
     """Search Google and get content of each link, including title, snippet, and og:description."""
     await load_cache()
-    search_results = batch_search_google(queries, num_results)
+    search_results = await batch_search_google(queries, num_results)
     final_results = []
     for result in search_results:
         if isinstance(result, str):
@@ -8,13 +8,26 @@ import sys
 import traceback
 import asyncio
 import re # Added for code extraction
+import hashlib
+import time
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from ollama import AsyncClient, Image
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import aiohttp
 import json
+try:
+    # C実装で文字列主体のdictのシリアライズが速い(無ければ標準jsonを使う)
+    import orjson
+except ImportError:
+    orjson = None
 from dotenv import load_dotenv
-import sqlite3
-import time
+try:
+    # ルール条件のマルチパターン照合用(無ければ線形走査にフォールバック)
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 from mem0 import Memory
 from mem0.configs.base import MemoryConfig
 
@@ -24,6 +37,18 @@ load_dotenv()
 
 # MODEL = "qwen3:32b"  # Default model, can be overridden by environment variable
 MODEL = "r1tool:latest"  # Default model, can be overridden by environment variable
+MAX_TURNS = 8  # スレッド毎にOllamaへ送る直近の往復数
+# 要約はメインモデルほどの能力を必要としないので、軽いモデルに差し替え可能にする
+SUMMARIZATION_MODEL = os.getenv("SUMMARIZATION_MODEL", MODEL)
+
+def _strip_think(s: str) -> str:
+    # split('</think>')は全断片をリスト化してしまう。
+    # 末尾だけ欲しいのでrfind+スライスで1パスで切り出す
+    i = s.rfind('</think>')
+    return s[i + len('</think>'):].strip() if i >= 0 else s.strip()
+
+# 呼び出しの度に再コンパイルしないようパターンはモジュールスコープに置く
+_RULE_RE = re.compile(r"システムプロンプト:\s*条件=(.+?),\s*プロンプト=(.+)", re.DOTALL)
 MEMORY_FEATURE_ENABLED = os.getenv("MEMORY_FEATURE_ENABLED", "false").lower() == "true"
 OLLAMA_BASE_URL = os.environ.get("OLLAMA_BASE_URL", "http://localhost:12345")
 
@@ -55,6 +80,27 @@ config = {
 
 memory = Memory.from_config(config)
 
+# mem0はsearch/addの度にクエリをOllamaで埋め込み直す。
+# 同一テキストのHTTP往復+GPU時間を省くため、埋め込みを
+# SHA-256キーのLRUで使い回すよう embedder をラップする
+_EMBED_CACHE: OrderedDict[str, list] = OrderedDict()
+_EMBED_CACHE_MAX = 4096
+_orig_embed = memory.embedding_model.embed
+
+def _cached_embed(text, *args, **kwargs):
+    key = hashlib.sha256(str(text).encode("utf-8")).hexdigest()
+    cached = _EMBED_CACHE.get(key)
+    if cached is not None:
+        _EMBED_CACHE.move_to_end(key)
+        return cached
+    embedding = _orig_embed(text, *args, **kwargs)
+    _EMBED_CACHE[key] = embedding
+    if len(_EMBED_CACHE) > _EMBED_CACHE_MAX:
+        _EMBED_CACHE.popitem(last=False)
+    return embedding
+
+memory.embedding_model.embed = _cached_embed
+
 async def chat_with_memories(message: str, user_id: str = "default_user") -> str:
     # Retrieve relevant memories
     relevant_memories = memory.search(query=message, user_id=user_id, limit=3)
@@ -67,7 +113,7 @@ async def chat_with_memories(message: str, user_id: str = "default_user") -> str
         model=MODEL,
         messages=messages,
     ),
-    assistant_response = response.message.content.split('</think>')[-1].strip()
+    assistant_response = _strip_think(response.message.content)
     # Create new memories from the conversation
     messages.append({"role": "assistant", "content": assistant_response})
     memory.add(messages, user_id=user_id)
@@ -92,6 +138,33 @@ SYSTEM_PROMPT_RULES: list[SystemPromptRule] = [
     )
 ]
 
+# ルール毎に `in` で走査するとO(ルール数×メッセージ長)になるため、
+# 全条件を1つのAho-Corasickオートマトンにまとめて1パスで照合する。
+# ルール変更時に _rebuild_rule_automaton() で作り直す
+_RULE_AUTOMATON = None
+_DEFAULT_PROMPT_TEMPLATE = ""
+_DEFAULT_RULE_IDX = -1  # 空条件のデフォルトルールの位置(無ければ-1)
+
+def _rebuild_rule_automaton() -> None:
+    global _RULE_AUTOMATON, _DEFAULT_PROMPT_TEMPLATE, _DEFAULT_RULE_IDX
+    _DEFAULT_RULE_IDX = next(
+        (i for i, rule in enumerate(SYSTEM_PROMPT_RULES) if not rule.condition), -1
+    )
+    _DEFAULT_PROMPT_TEMPLATE = (
+        SYSTEM_PROMPT_RULES[_DEFAULT_RULE_IDX].prompt_template if _DEFAULT_RULE_IDX != -1 else ""
+    )
+    if ahocorasick is None:
+        _RULE_AUTOMATON = None
+        return
+    automaton = ahocorasick.Automaton()
+    for i, rule in enumerate(SYSTEM_PROMPT_RULES):
+        if rule.condition:
+            automaton.add_word(rule.condition, (i, rule.prompt_template))
+    automaton.make_automaton()
+    _RULE_AUTOMATON = automaton
+
+_rebuild_rule_automaton()
+
 
 client = AsyncClient(
     host=os.environ["OLLAMA_HOST"],
@@ -137,34 +210,125 @@ def execute_python_code(code_string: str) -> dict:
         
     return {"stdout": stdout_result, "stderr": stderr_result}
 
+# execで動くコードはCPUや外部I/Oで長時間ブロックし得るうえ、
+# sys.stdout差し替えは並行ハンドラ同士で競合するため、
+# ボット本体とは別のワーカープロセスで実行する
+_CODE_POOL = ProcessPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+_CODE_TIMEOUT = 15  # 秒。暴走したスニペットにハンドラを塞がせない
+
+async def execute_python_code_async(code_string: str) -> dict:
+    loop = asyncio.get_running_loop()
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(_CODE_POOL, execute_python_code, code_string),
+            timeout=_CODE_TIMEOUT,
+        )
+    except asyncio.TimeoutError:
+        return {"stdout": "", "stderr": f"Execution timed out after {_CODE_TIMEOUT} seconds"}
+
+
+# memory.search はメッセージ毎に埋め込み計算+ベクトル検索を行うため、
+# 書き込みが無い間は同じ(user_id, query)の結果をメモリ上で使い回す。
+# add_memory で無効化されるので古い結果を返し続けることはない
+_MEM_CACHE: dict[tuple[str, str, int], list[str]] = {}
+
+# ベクトル検索は固有名詞・パス・識別子のような厳密一致に弱いので、
+# 要約テキストをFTS5にも入れてBM25の結果とRRFで融合する
+_FTS_DB_PATH = ".cache/slack_agent/memory_fts.db"
+os.makedirs(os.path.dirname(_FTS_DB_PATH), exist_ok=True)
+_fts_conn = sqlite3.connect(_FTS_DB_PATH, check_same_thread=False)
+# 接続はイベントループとワーカースレッドの両方から使うのでロックで直列化する
+_db_lock = threading.Lock()
+_fts_conn.execute("PRAGMA journal_mode=WAL")
+_fts_conn.execute("PRAGMA synchronous=NORMAL")
+_fts_conn.execute("PRAGMA temp_store=MEMORY")
+_fts_conn.execute(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS mem_fts USING fts5(content, user_id UNINDEXED, tokenize='unicode61')"
+)
+# スレッド履歴の永続化用。プロセスを再起動しても文脈を引き継げる
+_fts_conn.execute(
+    "CREATE TABLE IF NOT EXISTS msgs (thread_ts TEXT, seq INTEGER, role TEXT, content TEXT)"
+)
+_fts_conn.execute("CREATE INDEX IF NOT EXISTS idx_msgs_thread ON msgs(thread_ts, seq)")
+_fts_conn.commit()
+
+def _fts_search(user_id: str, query: str, limit: int = 10) -> list[str]:
+    terms = [t for t in query.split() if t]
+    if not terms:
+        return []
+    # ユーザー入力がFTS5のクエリ構文として解釈されないよう各語をクォートする
+    match_query = " OR ".join('"' + t.replace('"', '""') + '"' for t in terms)
+    try:
+        with _db_lock:
+            rows = _fts_conn.execute(
+                "SELECT content FROM mem_fts WHERE mem_fts MATCH ? AND user_id = ? ORDER BY bm25(mem_fts) LIMIT ?",
+                (match_query, user_id, limit),
+            ).fetchall()
+        return [row[0] for row in rows]
+    except sqlite3.Error as e:
+        print(f"Error during FTS search for user {user_id}: {e}")
+        return []
 
 def add_memory(text: str, user_id: str):
+    global _MEM_CACHE
     try:
         memory.add(text, user_id=user_id)
+        with _db_lock:
+            _fts_conn.execute("INSERT INTO mem_fts(content, user_id) VALUES(?, ?)", (text, user_id))
+            _fts_conn.commit()
+        _MEM_CACHE = {}
         print(f"Memory added for user {user_id}")
     except Exception as e:
         print(f"Error adding memory for user {user_id}: {e}")
 
 def get_recent_memories(user_id: str, query: str, limit: int = 5) -> list[str]:
+    cache_key = (user_id, query, limit)
+    if cache_key in _MEM_CACHE:
+        return _MEM_CACHE[cache_key]
     memories = []
     try:
         relevant_memories = memory.search(query=query, user_id=user_id, limit=limit)
-        memories = [entry['memory'] for entry in relevant_memories["results"]] if relevant_memories and relevant_memories.get("results") else []
+        vector_hits = [entry['memory'] for entry in relevant_memories["results"]] if relevant_memories and relevant_memories.get("results") else []
+        keyword_hits = _fts_search(user_id, query)
+        # Reciprocal Rank Fusion (k=60): 両方の上位に出るものを優先する
+        scores: dict[str, float] = {}
+        for hits in (vector_hits, keyword_hits):
+            for rank, mem in enumerate(hits):
+                scores[mem] = scores.get(mem, 0.0) + 1.0 / (60 + rank + 1)
+        memories = sorted(scores, key=scores.get, reverse=True)[:limit]
+        _MEM_CACHE[cache_key] = memories
         print(f"Retrieved {len(memories)} memories for user {user_id} with query '{query}'")
     except Exception as e:
         print(f"Error retrieving memories for user {user_id} with query '{query}': {e}")
     return memories
 
+# mem0のaddは同期APIで、内部で埋め込みとLLM呼び出しまで行うため、
+# イベントループ上で直接呼ぶとハンドラ全体が止まる。
+# キューに積んでワーカーがスレッドに逃がして順に書き込む
+_MEM_QUEUE: asyncio.Queue = asyncio.Queue()
+
+async def _mem_writer():
+    while True:
+        text, user_id = await _MEM_QUEUE.get()
+        await asyncio.to_thread(add_memory, text, user_id)
+
 def _construct_initial_system_prompt(thread_ts: str, user_message: str, user_id: str) -> str:
     system_prompt_content = ""
-    default_prompt_template = "" # Initialize default_prompt_template
-
-    for rule in SYSTEM_PROMPT_RULES:
-        if not rule.condition: # Check if condition is empty for default rule
-            default_prompt_template = rule.prompt_template
-        elif rule.condition in user_message:
-            system_prompt_content = rule.prompt_template
-            break # First match wins
+    default_prompt_template = _DEFAULT_PROMPT_TEMPLATE
+
+    if _RULE_AUTOMATON is not None:
+        # メッセージを1パス走査して全条件を同時照合し、
+        # 元の「最初に定義されたルールが勝つ」優先順位を保つ
+        best_index = None
+        for _, (rule_index, prompt_template) in _RULE_AUTOMATON.iter(user_message):
+            if best_index is None or rule_index < best_index:
+                best_index = rule_index
+                system_prompt_content = prompt_template
+    else:
+        for rule in SYSTEM_PROMPT_RULES:
+            if rule.condition and rule.condition in user_message:
+                system_prompt_content = rule.prompt_template
+                break # First match wins
 
     if not system_prompt_content: # If no specific rule matched
         if default_prompt_template: # Check if a default was found
@@ -175,15 +339,25 @@ def _construct_initial_system_prompt(thread_ts: str, user_message: str, user_id:
             system_prompt_content = "あなたは一般的なアシスタントです。ユーザーの質問に答えてください。"
             print(f"Warning: No matching system prompt rule found for user message and no default rule set. Using a generic default.")
 
-    if MEMORY_FEATURE_ENABLED:
-        recent_memories = get_recent_memories(user_id=user_id, query=user_message)
-        if recent_memories:
-            memory_header = "\n\n## Reference from Past Conversations (Summaries) - Use these lightly for context if relevant:\n"
-            formatted_memories = "\n".join([f"- {mem}" for mem in recent_memories])
-            system_prompt_content += memory_header + formatted_memories
-            print(f"System prompt for thread {thread_ts} now includes {len(recent_memories)} memories.")
+    # NOTE: 以前はここで記憶をシステムプロンプトに連結していたが、
+    # システムメッセージはスレッド内でバイト単位で同一に保つ方が
+    # Ollamaのプレフィックスキャッシュ(KVキャッシュ)が効くため、
+    # 記憶はターン毎に別のcontextメッセージとして付与する(_memory_context_message参照)
     return system_prompt_content
 
+def _memory_context_message(user_message: str, user_id: str) -> dict | None:
+    """その時点の関連記憶を、プロンプト末尾に挟む使い捨てのsystemメッセージにする。
+    固定プレフィックスの後ろに置くことでキャッシュヒットを妨げない。
+    """
+    if not MEMORY_FEATURE_ENABLED:
+        return None
+    recent_memories = get_recent_memories(user_id=user_id, query=user_message)
+    if not recent_memories:
+        return None
+    memory_header = "## Reference from Past Conversations (Summaries) - Use these lightly for context if relevant:\n"
+    formatted_memories = "\n".join([f"- {mem}" for mem in recent_memories])
+    return {"role": "system", "content": memory_header + formatted_memories}
+
 # Function to manage system prompt rules
 def manage_system_prompt_rules(user_message: str) -> str:
     global SYSTEM_PROMPT_RULES # Required to modify the global list
@@ -191,7 +365,7 @@ def manage_system_prompt_rules(user_message: str) -> str:
     # Regex to parse the user message
     # Expected format: "システムプロンプト: 条件=<keyword>, プロンプト=<prompt_text>"
     # Using re.DOTALL so that . matches newlines in prompt_text
-    match = re.match(r"システムプロンプト:\s*条件=(.+?),\s*プロンプト=(.+)", user_message, re.DOTALL)
+    match = _RULE_RE.match(user_message)
 
     if not match:
         return "無効なルール形式です。期待される形式: 「システムプロンプト: 条件=キーワード, プロンプト=プロンプトテキスト」"
@@ -206,26 +380,22 @@ def manage_system_prompt_rules(user_message: str) -> str:
     for rule in SYSTEM_PROMPT_RULES:
         if rule.condition == condition:
             rule.prompt_template = prompt_text
+            _rebuild_rule_automaton()
             return f"システムプロンプトのルールを更新しました。条件: '{condition}'"
 
     # If no rule with the condition exists, create a new one
     new_rule = SystemPromptRule(condition=condition, prompt_template=prompt_text)
 
     # Add the new rule before the default rule (empty condition string)
-    default_rule_index = -1
-    for i, rule in enumerate(SYSTEM_PROMPT_RULES):
-        if rule.condition == "":
-            default_rule_index = i
-            break
-
-    if default_rule_index != -1:
-        SYSTEM_PROMPT_RULES.insert(default_rule_index, new_rule)
+    if _DEFAULT_RULE_IDX != -1:
+        SYSTEM_PROMPT_RULES.insert(_DEFAULT_RULE_IDX, new_rule)
     else:
         # Fallback: if no default rule is found (should not happen with current setup),
         # append to the end. This ensures the rule is added.
         SYSTEM_PROMPT_RULES.append(new_rule)
         print("Warning: Default system prompt rule not found. New rule appended to the end.")
 
+    _rebuild_rule_automaton()
     return f"新しいシステムプロンプトのルールを作成しました。条件: '{condition}'"
 
 
@@ -233,13 +403,25 @@ def extract_python_code(text: str) -> list[str]:
     """
     Extracts all Python code snippets from markdown-like code blocks.
     Returns a list of string code snippets.
+    デリミタは固定文字列なので、正規表現(DOTALLの.*?はバッファ全体を
+    バックトラックし得る)ではなくstr.findの1パス走査で切り出す。
     """
-    # Pattern to find ```python ... ```
-    # re.findall will return a list of all captured groups (the code itself)
-    pattern = re.compile(r"```python\s*\n(.*?)\n```", re.DOTALL)
-    matches = pattern.findall(text)
-    # strip() each matched code block content
-    return [match.strip() for match in matches]
+    codes = []
+    start_token, end_token = "```python", "\n```"
+    i = 0
+    while True:
+        start = text.find(start_token, i)
+        if start < 0:
+            break
+        newline = text.find("\n", start + len(start_token))
+        if newline < 0:
+            break
+        end = text.find(end_token, newline + 1)
+        if end < 0:
+            break
+        codes.append(text[newline + 1:end].strip())
+        i = end + len(end_token)
+    return codes
 
 class UserRole(str, Enum):
     system = "system"
@@ -256,31 +438,71 @@ class Message(BaseModel):
         return f"{self.role}: {self.content}"
 
 
+# メッセージ毎にClientSessionを作るとコネクタ/DNS/TLSの初期化を
+# 毎回払うことになるため、keep-aliveの効く共有セッションを使い回す
+_HTTP: aiohttp.ClientSession | None = None
+
+async def _get_http() -> aiohttp.ClientSession:
+    global _HTTP
+    if _HTTP is None or _HTTP.closed:
+        _HTTP = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300)
+        )
+    return _HTTP
+
+# Slackのファイル CDN へ無制限に同時リクエストすると429が返り、
+# リトライ待ちでかえって遅くなるため同時実行数を絞る
+_slack_dl_sem = asyncio.Semaphore(5)
+_DL_MAX_ATTEMPTS = 3
+
+async def _fetch_one_image(session, file_info, headers):
+    image_url = file_info.get("url_private_download")
+    if not image_url:
+        return None
+    try:
+        for attempt in range(_DL_MAX_ATTEMPTS):
+            async with _slack_dl_sem:
+                async with session.get(image_url, headers=headers) as resp:
+                    if resp.status == 429:
+                        # Retry-Afterを尊重して待ってからやり直す
+                        retry_after = float(resp.headers.get("Retry-After", "1"))
+                        print(f"Rate limited downloading {image_url}, retrying in {retry_after}s")
+                        await asyncio.sleep(retry_after)
+                        continue
+                    if resp.status == 200:
+                        # resp.read()は全体を一括でbytes化するので、
+                        # チャンクごとにbytearrayへ流し込んでピークメモリを抑える
+                        buf = bytearray()
+                        async for chunk in resp.content.iter_chunked(65536):
+                            buf.extend(chunk)
+                        if not buf:
+                            print(f"Empty image bytes for {image_url}")
+                            return None
+                        return Image(value=bytes(buf))
+                    print(f"Error downloading image: {resp.status} from {image_url}")
+                    return None
+    except Exception as e:
+        print(f"Exception during image processing: {e}")
+    return None
+
 async def download_and_encode_images(files, slack_client_token):
     """
     Downloads images from Slack file objects and encodes them in base64.
+    各画像の取得は独立したHTTPSリクエストなので並行に走らせ、
+    合計時間を最も遅い1件分に抑える。
     """
-    base64_images = []
-    async with aiohttp.ClientSession() as session:
-        for file_info in files:
-            if file_info.get("mimetype", "").startswith("image/"):
-                image_url = file_info.get("url_private_download")
-                if image_url:
-                    try:
-                        # Slack API requires Authorization header with bot token
-                        headers = {"Authorization": f"Bearer {slack_client_token}"}
-                        async with session.get(image_url, headers=headers) as resp:
-                            if resp.status == 200:
-                                image_bytes = await resp.read()
-                                if not image_bytes:
-                                    print(f"Empty image bytes for {image_url}")
-                                    continue
-                                base64_images.append(Image(value=image_bytes))
-                            else:
-                                print(f"Error downloading image: {resp.status} from {image_url}")
-                    except Exception as e:
-                        print(f"Exception during image processing: {e}")
-    return base64_images
+    # Slack API requires Authorization header with bot token
+    headers = {"Authorization": f"Bearer {slack_client_token}"}
+    session = await _get_http()
+    results = await asyncio.gather(
+        *[
+            _fetch_one_image(session, file_info, headers)
+            for file_info in files
+            if file_info.get("mimetype", "").startswith("image/")
+        ],
+        return_exceptions=True,
+    )
+    return [result for result in results if isinstance(result, Image)]
 
 async def send(say, message: str, thread_ts):
     text = {
@@ -297,7 +519,84 @@ async def send(say, message: str, thread_ts):
     }
     await say(text, thread_ts=thread_ts)
 
+# ストリーミング中のSlack更新間隔(秒)。短すぎるとrate limitに当たる
+_STREAM_UPDATE_INTERVAL = 0.6
+
+async def _stream_chat_to_slack(messages, channel, thread_ts, posted_ts=None):
+    """Ollamaの生成をストリーミングで受け取り、生成途中のテキストを
+    Slackメッセージとして逐次更新する。ユーザーは全文生成を待たずに
+    最初のトークンから読み始められる。戻り値は (全文, 投稿ts)。
+    """
+    buf = ""
+    last_update = 0.0
+    stream = await client.chat(model=MODEL, messages=messages, stream=True)
+    async for chunk in stream:
+        buf += chunk["message"]["content"]
+        # 思考部分(</think>より前)はユーザーに見せない。
+        # thinkブロックが閉じるまでは_strip_thinkが全文を返してしまうので、
+        # 閉じタグが来るまで更新自体を止める
+        if '<think>' in buf and '</think>' not in buf:
+            continue
+        visible = _strip_think(buf)
+        if not visible:
+            continue
+        now = time.monotonic()
+        if now - last_update < _STREAM_UPDATE_INTERVAL:
+            continue
+        last_update = now
+        try:
+            if posted_ts is None:
+                resp = await app.client.chat_postMessage(channel=channel, thread_ts=thread_ts, text=visible)
+                posted_ts = resp["ts"]
+            else:
+                await app.client.chat_update(channel=channel, ts=posted_ts, text=visible)
+        except Exception as e:
+            print(f"Error streaming update to Slack: {e}")
+    return buf, posted_ts
+
 _messages = defaultdict(list)
+# create_taskの戻りを保持しないとタスクがGCされ得るので参照を持っておく
+_BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+def _persist_message(thread_ts: str, msg: Message) -> None:
+    try:
+        with _db_lock:
+            seq = _fts_conn.execute(
+                "SELECT COALESCE(MAX(seq), -1) + 1 FROM msgs WHERE thread_ts = ?", (thread_ts,)
+            ).fetchone()[0]
+            _fts_conn.execute(
+                "INSERT INTO msgs(thread_ts, seq, role, content) VALUES(?, ?, ?, ?)",
+                (thread_ts, seq, msg.role.value, msg.content),
+            )
+            _fts_conn.commit()
+    except sqlite3.Error as e:
+        print(f"Error persisting message for thread {thread_ts}: {e}")
+
+def _load_thread_history(thread_ts: str) -> list[Message]:
+    # 再起動後の最初のアクセスで直近の履歴だけをメモリに復元する
+    # (画像は保存していないのでテキストのみ)
+    try:
+        with _db_lock:
+            # seq=0のシステムプロンプトはウィンドウから溢れても必ず先頭に残す
+            first = _fts_conn.execute(
+                "SELECT role, content FROM msgs WHERE thread_ts = ? AND seq = 0", (thread_ts,)
+            ).fetchone()
+            rows = _fts_conn.execute(
+                "SELECT role, content FROM ("
+                "SELECT seq, role, content FROM msgs WHERE thread_ts = ? AND seq > 0 ORDER BY seq DESC LIMIT ?"
+                ") ORDER BY seq",
+                (thread_ts, MAX_TURNS * 2),
+            ).fetchall()
+        if first:
+            rows = [first] + rows
+        return [Message(role=UserRole(role), content=content) for role, content in rows]
+    except sqlite3.Error as e:
+        print(f"Error loading history for thread {thread_ts}: {e}")
+        return []
+
+def _append_message(thread_ts: str, msg: Message) -> None:
+    _messages[thread_ts].append(msg)
+    _persist_message(thread_ts, msg)
 
 @app.event("message")
 async def handle_app_mention(body, say, ack):
@@ -307,7 +606,7 @@ async def handle_app_mention(body, say, ack):
     user_message = body["event"].get("text", "") or body["event"].get("message", {}).get("text", "")
     thread_ts = body["event"].get("thread_ts", body["event"]["ts"])
     slack_user_id = body["event"].get("user")
-    # channel_id = body["event"]["channel"] # Useful for potential logging or context
+    channel_id = body["event"]["channel"]
 
     # --- START NEW INTEGRATION ---
     if user_message.startswith("システムプロンプト:"):
@@ -320,18 +619,24 @@ async def handle_app_mention(body, say, ack):
     # but it's used below for image handling.
     # base_system_prompt is also no longer needed here.
 
+    if not _messages.get(thread_ts):
+        # 再起動後の既存スレッドはまずSQLiteから直近履歴を復元する
+        restored_history = _load_thread_history(thread_ts)
+        if restored_history:
+            _messages[thread_ts] = restored_history
+
     if not _messages.get(thread_ts):
         # Construct system prompt based on user message using the new rule-based function
         final_system_prompt = _construct_initial_system_prompt(thread_ts, user_message, slack_user_id)
-        _messages[thread_ts].append(
-            Message(role=UserRole.system, content=final_system_prompt)
+        _append_message(
+            thread_ts, Message(role=UserRole.system, content=final_system_prompt)
         )
 
     base64_images = []
     if body["event"].get("files"):
         base64_images = await download_and_encode_images(body["event"]["files"], app.client.token)
-    
-    _messages[thread_ts].append(Message(role=UserRole.user, content=user_message, images=base64_images if base64_images else None))
+
+    _append_message(thread_ts, Message(role=UserRole.user, content=user_message, images=base64_images if base64_images else None))
     
     # Convert Message objects to dictionaries for Ollama client
     # The ollama client expects a list of dicts.
@@ -339,63 +644,93 @@ async def handle_app_mention(body, say, ack):
     # Let's ensure this by passing the list of Message objects directly.
     
     ollama_messages_for_first_call = []
-    for msg in _messages[thread_ts]:
+    last_index = len(_messages[thread_ts]) - 1
+    for i, msg in enumerate(_messages[thread_ts]):
         msg_dict = {"role": msg.role.value, "content": msg.content}
-        if msg.images: # Only include images if present
+        # 画像は一度モデルに見せれば十分なので、最新メッセージの分だけ送る
+        if msg.images and i == last_index:
             msg_dict["images"] = msg.images
         ollama_messages_for_first_call.append(msg_dict)
 
-    res = await client.chat(
-        model=MODEL, # Or your preferred model
-        messages=ollama_messages_for_first_call # Pass the list of dicts
+    # 関連記憶はシステムプロンプトを汚さず、ユーザーメッセージの直前に挟む。
+    # mem0の検索とFTSクエリは同期I/Oなのでスレッドに逃がす
+    memory_context = await asyncio.to_thread(_memory_context_message, user_message, slack_user_id)
+    if memory_context is not None:
+        ollama_messages_for_first_call.insert(-1, memory_context)
+
+    raw_content, posted_ts = await _stream_chat_to_slack(
+        ollama_messages_for_first_call, channel_id, thread_ts
     )
-    assistant_message_content = res.message.get('content', '').split('</think>')[-1] # Ensure content key exists
+    assistant_message_content = _strip_think(raw_content)
 
     # Attempt to extract python code from the assistant's message
     codes_to_execute = extract_python_code(assistant_message_content) # Now a list
     print(f"Extracted code blocks: {assistant_message_content}")
     print(f"Extracted code blocks: {codes_to_execute}")
 
+    # 最後にアシスタント応答を履歴へ追記するかどうか。
+    # コード実行しても出力が無く最初の応答を使い回す場合は、
+    # 既に履歴に入っているので二重追記しない
+    final_response_is_new = True
+
     if codes_to_execute: # Check if the list is not empty
         # Store the original assistant message that contained the code blocks
-        _messages[thread_ts].append(Message(role=UserRole.assistant, content=assistant_message_content))
+        _append_message(thread_ts, Message(role=UserRole.assistant, content=assistant_message_content))
 
-        # Loop through each extracted code string and process it
-        for code_string in codes_to_execute:
-            execution_result = execute_python_code(code_string)
-            tool_message_content = json.dumps(execution_result)
+        # 各コードブロックは独立なのでワーカープロセスで並列実行する
+        execution_results = await asyncio.gather(
+            *[execute_python_code_async(code_string) for code_string in codes_to_execute]
+        )
+        tool_dicts = []
+        for execution_result in execution_results:
+            if orjson is not None:
+                tool_message_content = orjson.dumps(execution_result).decode()
+            else:
+                tool_message_content = json.dumps(execution_result)
             print(f"Execution result: {tool_message_content}")
-            _messages[thread_ts].append(Message(role=UserRole.tool, content=tool_message_content))
+            _append_message(thread_ts, Message(role=UserRole.tool, content=tool_message_content))
+            tool_dicts.append({"role": UserRole.tool.value, "content": tool_message_content})
+
+        # 全ブロックが何も出力しなかった場合(関数定義だけ等)は、
+        # 2回目の推論をしてもモデルに新しい情報が無いので最初の応答を使う
+        has_output = any(r["stdout"] or r["stderr"] for r in execution_results)
+        if has_output:
+            # 履歴全体をもう一度dict化せず、1回目に送ったリストへ
+            # アシスタント応答とツール結果を追記して使い回す
+            ollama_messages_for_second_call = ollama_messages_for_first_call
+            # 画像は1回目で送信済みなので2回目のペイロードからは外す
+            ollama_messages_for_second_call[-1].pop("images", None)
+            ollama_messages_for_second_call.append(
+                {"role": UserRole.assistant.value, "content": assistant_message_content}
+            )
+            ollama_messages_for_second_call.extend(tool_dicts)
+
+            # Call Ollama again with the tool's output
+            # ツール実行後の応答も同じSlackメッセージに流し込む
+            raw_content, posted_ts = await _stream_chat_to_slack(
+                ollama_messages_for_second_call, channel_id, thread_ts, posted_ts
+            )
+            assistant_message_content = _strip_think(raw_content)
+        else:
+            final_response_is_new = False
 
-        # Prepare messages for the second Ollama call, after all tool messages are added
-        ollama_messages_for_second_call = []
-        for msg in _messages[thread_ts]:
-            msg_dict = {"role": msg.role.value, "content": msg.content}
-            # Images are not typically sent with tool responses or subsequent system messages
-            # if msg.images: 
-            #     msg_dict["images"] = msg.images
-            ollama_messages_for_second_call.append(msg_dict)
-        
-        # Call Ollama again with the tool's output
-        res = await client.chat(
-            model=MODEL,
-            messages=ollama_messages_for_second_call
-        )
-        assistant_message_content = res.message.get('content', '').split('</think>')[-1]
-    
     # Append the final assistant message (either from the first or second call)
-    _messages[thread_ts].append(Message(role=UserRole.assistant, content=assistant_message_content))
+    if final_response_is_new:
+        _append_message(thread_ts, Message(role=UserRole.assistant, content=assistant_message_content))
+
+    # 履歴を無制限に伸ばすと毎回全履歴を再送することになるため、
+    # システムプロンプト+直近MAX_TURNS往復に刈り込み、
+    # 送信済みの古い画像はここで落とす
+    msgs = _messages[thread_ts]
+    if len(msgs) > MAX_TURNS * 2 + 1:
+        _messages[thread_ts] = [msgs[0]] + msgs[-MAX_TURNS * 2:]
+    for msg in _messages[thread_ts][:-1]:
+        msg.images = None
 
     if MEMORY_FEATURE_ENABLED:
         summarization_history_parts = []
-        # _messages[thread_ts] already contains the history up to the point *before* the current assistant's response is added.
-        # The current assistant's response (assistant_message_content) also needs to be included.
-
-        temp_history_for_summarization = list(_messages[thread_ts]) # Make a copy
-        # Add the latest assistant message to this temporary history for summarization
-        temp_history_for_summarization.append(Message(role=UserRole.assistant, content=assistant_message_content))
-
-        for msg in temp_history_for_summarization:
+        # 刈り込み後の _messages[thread_ts] には最新のアシスタント応答まで含まれる
+        for msg in _messages[thread_ts]:
             if msg.role == UserRole.system: # Skip system messages for the summarization input
                 continue
             # For tool messages, we might want to indicate the output clearly.
@@ -404,52 +739,94 @@ async def handle_app_mention(body, say, ack):
                 summarization_history_parts.append(f"Tool Output: {msg.content}")
             else: # User and Assistant messages
                 summarization_history_parts.append(f"{msg.role.value.capitalize()}: {msg.content}")
-                
+
         full_conversation_history_text = "\n".join(summarization_history_parts)
 
         if full_conversation_history_text: # Proceed only if there's something to summarize
-            summarization_prompt_content = (
-                "You are a minute-taking assistant. Based on the following conversation history, "
-                "create a concise summary or overview of the discussion. "
-                "Do not include who said what (no speaker attribution). "
-                "Focus on the key topics, decisions, and outcomes discussed.\n\n"
-                "Conversation History:\n"
-                f"{full_conversation_history_text}"
+            # 要約の推論を待ってから返信するとその分ユーザーを待たせるので、
+            # バックグラウンドタスクに任せて先に応答を送る
+            task = asyncio.create_task(
+                _summarize_and_store(thread_ts, full_conversation_history_text, slack_user_id)
             )
-            summarization_messages = [{"role": "user", "content": summarization_prompt_content}]
+            _BACKGROUND_TASKS.add(task)
+            task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+    # ストリーミング中の投稿を最終内容で確定させる。
+    # 一度も投稿できていなければ(生成が極端に速い場合など)通常送信する
+    if posted_ts is not None:
+        try:
+            await app.client.chat_update(channel=channel_id, ts=posted_ts, text=assistant_message_content)
+        except Exception as e:
+            print(f"Error finalizing streamed message: {e}")
+    else:
+        await send(say, assistant_message_content, thread_ts)
 
-            try:
-                summary_res = await client.chat(
-                    model=MODEL, # Or your preferred model
-                    messages=summarization_messages
-                )
-                interaction_summary = summary_res.message.get('content', '').strip()
-                if interaction_summary:
-                    add_memory(text=interaction_summary, user_id=slack_user_id)
-                else:
-                    print(f"Summarization result was empty for thread {thread_ts}")
-            except Exception as e:
-                print(f"Error during summarization call for thread {thread_ts}: {e}")
 
-    await send(say, assistant_message_content, thread_ts)
+async def _summarize_and_store(thread_ts, conversation_text: str, user_id: str):
+    summarization_prompt_content = (
+        "You are a minute-taking assistant. Based on the following conversation history, "
+        "create a concise summary or overview of the discussion. "
+        "Do not include who said what (no speaker attribution). "
+        "Focus on the key topics, decisions, and outcomes discussed.\n\n"
+        "Conversation History:\n"
+        f"{conversation_text}"
+    )
+    summarization_messages = [{"role": "user", "content": summarization_prompt_content}]
+
+    try:
+        summary_res = await client.chat(
+            model=SUMMARIZATION_MODEL,
+            messages=summarization_messages
+        )
+        interaction_summary = summary_res.message.get('content', '').strip()
+        if interaction_summary:
+            _MEM_QUEUE.put_nowait((interaction_summary, user_id))
+        else:
+            print(f"Summarization result was empty for thread {thread_ts}")
+    except Exception as e:
+        print(f"Error during summarization call for thread {thread_ts}: {e}")
 
 
 async def warm_up():
     """
     Warm up the Ollama client by making a simple request.
     This can help avoid cold start issues.
+    メモリ機能が有効な場合は埋め込みモデルとベクトルストアも温め、
+    最初のSlackイベントがモデルロードやインデックスオープンを払わずに済むようにする。
     """
-    try:
-        await client.chat(
-            model=MODEL,
-            messages=[]
-        )
-        print("Ollama client warmed up successfully.")
-    except Exception as e:
-        print(f"Error during warm-up: {e}")
+    async def _warm_chat():
+        try:
+            await client.chat(
+                model=MODEL,
+                messages=[]
+            )
+            print("Ollama client warmed up successfully.")
+        except Exception as e:
+            print(f"Error during warm-up: {e}")
+
+    async def _warm_memory():
+        try:
+            await client.embed(model="mxbai-embed-large", input="hi")
+            # memory.searchは同期APIなのでスレッドに逃がす
+            await asyncio.to_thread(memory.search, query="hi", user_id="__warm__", limit=1)
+            print("Memory store warmed up successfully.")
+        except Exception as e:
+            print(f"Error during memory warm-up: {e}")
+
+    warm_tasks = [_warm_chat()]
+    if MEMORY_FEATURE_ENABLED:
+        warm_tasks.append(_warm_memory())
+        # 記憶書き込みワーカーもここで起動する(実行中のループに紐付く)
+        writer_task = asyncio.get_running_loop().create_task(_mem_writer())
+        _BACKGROUND_TASKS.add(writer_task)
+    await asyncio.gather(*warm_tasks)
 
 
 if __name__ == "__main__":
     handler = AsyncSocketModeHandler(app, os.environ["SLACK_APP_TOKEN"], loop=asyncio.get_event_loop())
     asyncio.get_event_loop().run_until_complete(warm_up())
-    asyncio.get_event_loop().run_until_complete(handler.start_async())
+    try:
+        asyncio.get_event_loop().run_until_complete(handler.start_async())
+    finally:
+        if _HTTP is not None and not _HTTP.closed:
+            asyncio.get_event_loop().run_until_complete(_HTTP.close())